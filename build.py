@@ -1,32 +1,137 @@
 import argparse
-import docker
+import functools
+import hashlib
+import heapq
+import json
 import os
 import subprocess
 import sys
-import toml
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
+# The docker daemon uploads at most 5 layers concurrently by default (--max-concurrent-uploads).
+MAX_PUSH_WORKERS = 5
+
+# Name of the Dockerfile inside each build context.
+DOCKERFILE = "Dockerfile"
+# Build contexts larger than this are reported together with their largest files.
+CONTEXT_SIZE_WARNING = 100 * 1024 * 1024
+
+# Buildx builder used for building; the default `docker` driver cannot export a registry cache.
+BUILDX_BUILDER = "build-py"
+
+# Seconds to wait for a response from the docker daemon before giving up.
+DOCKER_TIMEOUT = 120
+# Seconds to wait for `bump-my-version` before giving up.
+BUMP_TIMEOUT = 60
+
+VERSION_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "build-py")
+# Parsed `tool.bumpversion` tables, keyed by path, inode, size and modification time.
+_version_cache = {}
+
 
 # Function to get and return a Docker client instance from the environment.
+@functools.cache
 def get_docker_client():
-    """Create and return a Docker client instance based on environment configuration."""
-    return docker.from_env()
+    """Create a Docker client instance based on environment configuration, or return the existing one.
+
+    Reusing the client keeps its HTTP session, and with it the open connections, across calls.
+    """
+    # Imported here so that runs exiting early never load the docker SDK
+    import docker
+
+    use_ssh_client = os.getenv("DOCKER_HOST", "").startswith("ssh://")
+    return docker.from_env(timeout=DOCKER_TIMEOUT, use_ssh_client=use_ssh_client)
+
+
+# Function to build the `bump-my-version` command line.
+def bump_version_command(version_file):
+    """Return the `bump-my-version` command that bumps the patch version in the specified file."""
+    return ["bump-my-version", "bump", "patch", "--config-file", f"{version_file}", "--allow-dirty"]
 
 
 # Function to bump the project version using the `bump-my-version` command.
-def bump_version(version_file):
-    """Run the `bump-my-version` command to bump the project's version."""
-    command = ["bump-my-version", "bump", "patch", "--config-file", f"{version_file}", "--allow-dirty"]
-    subprocess.run(command)
+def bump_version(version_file, current_version):
+    """Run the `bump-my-version` command to bump the project's version.
+
+    Args:
+        version_file: Path to the TOML file holding the version.
+        current_version: Version before the bump, used to verify that it changed.
+
+    Returns:
+        True if the version was bumped, False otherwise.
+    """
+    try:
+        result = subprocess.run(bump_version_command(version_file), check=True, capture_output=True, text=True,
+                                timeout=BUMP_TIMEOUT)
+    except subprocess.CalledProcessError as e:
+        print(f"An error occurred while bumping the version:\n{e.stdout}{e.stderr}")
+        return False
+    except subprocess.TimeoutExpired as e:
+        # Partial output may be bytes here even with text=True
+        output = "".join(stream.decode(errors="replace") if isinstance(stream, bytes) else stream or ""
+                         for stream in (e.stdout, e.stderr))
+        print(f"Bumping the version timed out:\n{output}")
+        return False
+    print(result.stdout, end="")
+
+    if get_current_version(version_file) == current_version:
+        print(f"Version is still {current_version} after bumping.")
+        return False
+    return True
+
+
+# Function to parse a TOML file, reusing earlier results while the file is unchanged.
+def load_bumpversion_config(version_file):
+    """Parse the `tool.bumpversion` table of the TOML version file, caching it in memory and on disk.
+
+    The cache is keyed by the file's inode, size and modification time, so it is invalidated as
+    soon as the file changes (e.g. after a version bump).
+
+    Args:
+        version_file: Path to the TOML file.
+
+    Returns:
+        The `tool.bumpversion` table as a dict.
+    """
+    st = os.stat(version_file)
+    path = os.path.abspath(version_file)
+    stat_key = [st.st_ino, st.st_size, st.st_mtime_ns]
+    key = (path, *stat_key)
+    if key in _version_cache:
+        return _version_cache[key]
+
+    cache_file = os.path.join(VERSION_CACHE_DIR, f"{hashlib.sha256(path.encode()).hexdigest()}.json")
+    try:
+        with open(cache_file, 'r') as json_file:
+            cached = json.load(json_file)
+        if cached["stat"] == stat_key:
+            _version_cache[key] = cached["data"]
+            return cached["data"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    import tomllib
+
+    with open(version_file, 'rb') as toml_file:
+        config = tomllib.load(toml_file)["tool"]["bumpversion"]
+    _version_cache[key] = config
+    try:
+        # Values JSON cannot represent (e.g. TOML dates) are not persisted, so warm reads match cold ones
+        serialized = json.dumps({"stat": stat_key, "data": config})
+        os.makedirs(VERSION_CACHE_DIR, exist_ok=True)
+        with open(cache_file, 'w') as json_file:
+            json_file.write(serialized)
+    except (OSError, TypeError, ValueError):
+        pass
+    return config
 
 
 # Function to read the current project version from a TOML configuration file.
 def get_current_version(version, is_production=True):
     if is_production:
         """Read and return the current project version from the specified TOML file."""
-        with open(version, 'r') as toml_file:
-            parsed_toml = toml.load(toml_file)
-        return parsed_toml["tool"]["bumpversion"]["current_version"]
+        return load_bumpversion_config(version)["current_version"]
     
     return version
 
@@ -44,6 +149,8 @@ def docker_login(client, username, password, registry):
     Returns:
         True if login was successful, False otherwise.
     """
+    import docker
+
     try:
         client.login(username=username, password=password, registry=registry)
         print("Successfully logged into container registry.")
@@ -53,18 +160,192 @@ def docker_login(client, username, password, registry):
         return False
 
 
+# Function to log in to a Docker registry with the docker CLI, which is used by buildx.
+def buildx_login(username, password, registry):
+    """Log in to the Docker registry with the docker CLI so that buildx can push to it.
+
+    Args:
+        username: Username for the registry.
+        password: Password for the registry.
+        registry: Registry URL.
+
+    Returns:
+        True if login was successful, False otherwise.
+    """
+    command = ["docker", "login", "--username", username, "--password-stdin", registry]
+    result = subprocess.run(command, input=password, capture_output=True, text=True)
+    if result.returncode != 0:
+        print(f"An error occurred: {result.stderr.strip()}")
+        return False
+    print("Successfully logged into container registry.")
+    return True
+
+
+# Function to warn about large build contexts before they are sent to the docker daemon.
+def check_build_context(build_path):
+    """Sum up the files that would be sent as build context and warn if it is unusually large.
+
+    Files excluded by the `.dockerignore` in the build path are not counted.
+
+    Args:
+        build_path: Path to the directory containing the Dockerfile.
+    """
+    import docker
+
+    patterns = []
+    dockerignore = os.path.join(build_path, ".dockerignore")
+    if os.path.exists(dockerignore):
+        with open(dockerignore, 'r') as ignore_file:
+            patterns = [line.strip() for line in ignore_file if line.strip() and not line.startswith("#")]
+
+    files = []
+    for path in docker.utils.exclude_paths(build_path, patterns, dockerfile=DOCKERFILE):
+        full_path = os.path.join(build_path, path)
+        if os.path.isfile(full_path) and not os.path.islink(full_path):
+            files.append((os.path.getsize(full_path), path))
+
+    total = sum(size for size, _ in files)
+    if total > CONTEXT_SIZE_WARNING:
+        print(f"Warning: build context {build_path} is {total / 1024 ** 2:.1f} MB, consider extending .dockerignore.")
+        for size, path in heapq.nlargest(10, files):
+            print(f"  {size / 1024 ** 2:8.1f} MB  {path}")
+
+
+# Function to log out of a Docker registry with the docker CLI.
+def buildx_logout(registry):
+    """Remove the registry credentials that `buildx_login` stored in the docker CLI config.
+
+    Args:
+        registry: Registry URL.
+    """
+    result = subprocess.run(["docker", "logout", registry], capture_output=True, text=True)
+    if result.returncode != 0:
+        print(f"An error occurred while logging out of the container registry: {result.stderr.strip()}")
+
+
+# Function to make sure the buildx builder exists, creating it if necessary.
+def buildx_create_builder():
+    """Create the `docker-container` buildx builder unless it already exists.
+
+    Returns:
+        True if the builder is available, False otherwise.
+    """
+    inspect = subprocess.run(["docker", "buildx", "inspect", BUILDX_BUILDER], capture_output=True, text=True)
+    if inspect.returncode == 0:
+        return True
+    command = ["docker", "buildx", "create", "--name", BUILDX_BUILDER, "--driver", "docker-container"]
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        print(f"An error occurred while creating the buildx builder: {result.stderr.strip()}")
+        return False
+    print(f"Created buildx builder {BUILDX_BUILDER}.")
+    return True
+
+
+# Function to build a Docker image with BuildKit and push it to the registry in one step.
+def buildx_image(build_path, image_name, cache_ref):
+    """Build a Docker image with `docker buildx` and push it directly to the registry.
+
+    Args:
+        build_path: Path to the directory containing the Dockerfile.
+        image_name: Name to tag the image with.
+        cache_ref: Registry reference used to store and restore the build cache.
+
+    Returns:
+        True if the build and push were successful, False otherwise.
+    """
+    print(f"Building and pushing container image: {image_name}")
+    command = [
+        "docker", "buildx", "build", "--push",
+        "--builder", BUILDX_BUILDER,
+        "--tag", image_name,
+        "--cache-from", f"type=registry,ref={cache_ref}",
+        "--cache-to", f"type=registry,ref={cache_ref},mode=max",
+        "--file", os.path.join(build_path, DOCKERFILE),
+        build_path,
+    ]
+    try:
+        subprocess.run(command, check=True, env={**os.environ, "DOCKER_BUILDKIT": "1"})
+    except subprocess.CalledProcessError:
+        print(f"An error occurred while building the image {image_name}.")
+        return False
+    print(f"Image {image_name} successfully built and pushed.")
+    return True
+
+
+# Function to build and push several Docker images with BuildKit concurrently.
+def buildx_images(builds):
+    """Build and push Docker images with `docker buildx` in parallel.
+
+    Args:
+        builds: Tuples of build path, image name and cache reference, one per image.
+
+    Returns:
+        True if all images were built and pushed successfully, False otherwise.
+    """
+    with ThreadPoolExecutor(max_workers=min(len(builds), MAX_PUSH_WORKERS)) as executor:
+        results = list(executor.map(lambda build: buildx_image(*build), builds))
+    return all(results)
+
+
+# Function to parse a build target of the form `PATH[:NAME]`.
+def parse_target(target, default_name):
+    """Split a build target into its build path and image name.
+
+    Args:
+        target: Target string in the form `PATH[:NAME]`.
+        default_name: Image name to use if the target does not specify one.
+
+    Returns:
+        Tuple of build path and image name.
+    """
+    path, _, name = target.partition(":")
+    return path or ".", name or default_name
+
+
+# Function to check whether an image tag already exists in the registry.
+def image_exists(client, image_name, username, password):
+    """Check whether the image has already been pushed to the registry.
+
+    Args:
+        client: Docker client instance.
+        image_name: Name of the image to look up.
+        username: Username for the registry.
+        password: Password for the registry.
+
+    Returns:
+        True if the registry has a manifest for the image, False otherwise.
+    """
+    import docker
+
+    try:
+        client.images.get_registry_data(image_name, auth_config={"username": username, "password": password})
+        return True
+    except docker.errors.APIError:
+        return False
+
+
 # Function to build a Docker image from a specified path and tag it.
 def build_image(client, build_path, image_name):
     """Build a Docker image from the specified path and tag it.
 
     Args:
         client: Docker client instance.
-        path: Path to the directory containing the Dockerfile.
+        build_path: Path to the directory containing the Dockerfile.
         image_name: Name to tag the image with.
+
+    Returns:
+        True if the build was successful, False otherwise.
     """
     print(f"Building container image: {image_name}")
-    [line for line in client.images.build(path=build_path, tag=image_name, rm=True)]
+    # Stream the build log as it arrives instead of collecting it in memory
+    for chunk in client.api.build(path=build_path, dockerfile=DOCKERFILE, tag=image_name, rm=True, decode=True):
+        if "error" in chunk:
+            print(f"An error occurred while building the image: {chunk['error']}")
+            return False
+        sys.stderr.write(chunk.get("stream", ""))
     print(f"Image {image_name} build successfully!")
+    return True
 
 
 # Function to push a Docker image to a registry.
@@ -74,26 +355,61 @@ def push_image(client, image_name):
     Args:
         client: Docker client instance.
         image_name: Name of the image to push.
+
+    Returns:
+        True if the push was successful, False otherwise.
     """
+    import docker
+
     try:
+        # Only print when a layer changes status, not for every progress update
+        layer_status = {}
         for line in client.images.push(image_name, stream=True, decode=True):
-            print(line)
+            if "error" in line:
+                print(f"An error occurred while pushing the image {image_name}: {line['error']}")
+                return False
+            layer, status = line.get("id"), line.get("status")
+            if status and layer_status.get(layer) != status:
+                layer_status[layer] = status
+                print(f"{image_name} {layer}: {status}" if layer else f"{image_name}: {status}")
         print(f"Image {image_name} successfully pushed.")
+        return True
     except docker.errors.APIError as e:
-        print(f"An error occurred while pushing the image: {e}")
+        print(f"An error occurred while pushing the image {image_name}: {e}")
+        return False
+
+
+# Function to push several Docker images to a registry concurrently.
+def push_images(client, image_names):
+    """Push Docker images to a registry in parallel.
+
+    The registry login has to happen beforehand, the workers share the client's credentials.
+
+    Args:
+        client: Docker client instance.
+        image_names: Names of the images to push.
+
+    Returns:
+        True if all images were pushed successfully, False otherwise.
+    """
+    with ThreadPoolExecutor(max_workers=min(len(image_names), MAX_PUSH_WORKERS)) as executor:
+        results = list(executor.map(lambda image_name: push_image(client, image_name), image_names))
+    return all(results)
 
 
 # Function to remove a Docker image from the local system.
 def remove_image(client, image_name):
-    """Remove a Docker image from the local system and prune any dangling images.
+    """Remove a Docker image and its untagged parent layers from the local system.
 
     Args:
         client: Docker client instance.
         image_name: Name of the image to remove.
     """
+    import docker
+
     try:
-        client.images.remove(image=image_name)
-        client.images.prune(filters={'dangling': True})
+        # Deleting the image also deletes its untagged parents, without scanning the whole image store
+        client.api.remove_image(image_name, force=False, noprune=False)
         print(f"Image {image_name} successfully removed.")
     except docker.errors.ImageNotFound:
         print(f"Image {image_name} not found.")
@@ -107,56 +423,120 @@ def main():
     load_dotenv()
 
     parser = argparse.ArgumentParser()
-    parser.add_argument('-e', '--environment', type=str, default='production', required=True, help='deployment environment')
+    parser.add_argument('--production', action=argparse.BooleanOptionalAction, default=True,
+                        help='read and bump the version from the $VERSION file instead of using it as-is')
     parser.add_argument('-v', '--version', type=str, default=None, nargs='?', help='version as string')
+    parser.add_argument('-t', '--target', action='append', default=None, metavar='PATH[:NAME]',
+                        help='build context and image name, can be repeated (default: .:$PROJECT_NAME)')
+    parser.add_argument('--buildx', action=argparse.BooleanOptionalAction, default=True,
+                        help='build and push with docker buildx and a registry build cache')
+    parser.add_argument('--bump-only', action='store_true', help='only bump the version, do not build or push')
+    parser.add_argument('--force', action='store_true', help='build and push even if the images already exist')
     args = parser.parse_args()
+    if args.bump_only and not args.production:
+        parser.error("--bump-only requires --production")
 
-    if args.version is not None and not args.environment == 'production':
+    if args.version is not None and not args.production:
         version = args.version
     else:
-        version = os.getenv("VERSION")
+        version = os.environ.get("VERSION")
+
+    if args.bump_only:
+        if version is None:
+            print("Missing required environment variables: VERSION")
+            sys.exit(1)
+        # Nothing is left to do afterwards, so replace this process instead of waiting on a child
+        command = bump_version_command(version)
+        os.execvp(command[0], command)
+
     # Attempt to read the environment variables. If a variable is not set, None is returned
     # (alternatively, a default value could be specified here).
-    project_name = os.getenv("PROJECT_NAME")
-    registry_username = os.getenv("REGISTRY_USERNAME")
-    registry_password = os.getenv("REGISTRY_PASSWORD")
-    registry_name = os.getenv("REGISTRY_NAME")
+    required_vars = {
+        "VERSION": version,
+        "PROJECT_NAME": os.environ.get("PROJECT_NAME"),
+        "REGISTRY_USERNAME": os.environ.get("REGISTRY_USERNAME"),
+        "REGISTRY_PASSWORD": os.environ.get("REGISTRY_PASSWORD"),
+        "REGISTRY_NAME": os.environ.get("REGISTRY_NAME"),
+    }
 
     # Check if all required environment variables are present
-    required_vars = [version, project_name, registry_username, registry_password, registry_name]
-    if any(var is None for var in required_vars):
-        print("Some required environment variables are missing. Please ensure all needed variables are set.")
+    missing_vars = [name for name, value in required_vars.items() if value is None]
+    if missing_vars:
+        print(f"Missing required environment variables: {', '.join(missing_vars)}")
         sys.exit(1)
+    project_name = required_vars["PROJECT_NAME"]
+    registry_username = required_vars["REGISTRY_USERNAME"]
+    registry_password = required_vars["REGISTRY_PASSWORD"]
+    registry_name = required_vars["REGISTRY_NAME"]
 
     # Retrieve the current version from the specified file
-    if args.environment == 'production':
-        current_version = get_current_version(version)
-        # Perform the version bumping
-        bump_version(version)
-    else:
-        current_version = get_current_version(version, is_production=False)
+    current_version = get_current_version(version, is_production=args.production)
     print(f"Current version: {current_version}")
 
-    # Construct the URL for the Docker registry
-    registry_url = f"https://{registry_name}/"
+    # Paths to the Dockerfiles and names of the images to be built
+    targets = [parse_target(target, project_name) for target in args.target or ["."]]
+    names = [name for _, name in targets]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        parser.error(f"image names must be unique, give each --target its own NAME: {', '.join(duplicates)}")
+    invalid_paths = [build_path for build_path, _ in targets if not os.path.isdir(build_path)]
+    if invalid_paths:
+        parser.error(f"build context is not a directory: {', '.join(invalid_paths)}")
+    images = [(build_path, f"{registry_name}/{name}:{current_version}") for build_path, name in targets]
 
     # Create an instance of the Docker client
     client = get_docker_client()
 
+    # Skip the version bump, login and build if every image has already been pushed
+    if not args.force and all(image_exists(client, image_name, registry_username, registry_password)
+                              for _, image_name in images):
+        print(f"Images for version {current_version} already pushed, nothing to do.")
+        sys.exit(0)
+
+    for build_path, _ in images:
+        check_build_context(build_path)
+
+    # Perform the version bumping
+    if args.production and not bump_version(version, current_version):
+        sys.exit(1)
+
+    # Construct the URL for the Docker registry
+    registry_url = f"https://{registry_name}/"
+
+    if args.buildx:
+        # BuildKit pushes the layers while building, so nothing is left behind in the local image store
+        if not buildx_login(registry_username, registry_password, registry_url):
+            sys.exit(1)
+        # The docker CLI stores the password on disk, so never leave it behind on the runner
+        try:
+            if not buildx_create_builder():
+                sys.exit(1)
+            builds = [(build_path, image_name, f"{registry_name}/{name}:buildcache")
+                      for (build_path, image_name), (_, name) in zip(images, targets)]
+            if not buildx_images(builds):
+                sys.exit(1)
+        finally:
+            buildx_logout(registry_url)
+        return
+
     # Attempt to log in to the Docker registry
     if not docker_login(client, registry_username, registry_password, registry_url):
         sys.exit(1)
 
-    # Path to the Dockerfile and name of the image to be built
-    build_path = "."
-    image_name = f"{registry_name}/{project_name}:{current_version}"
-
-    # Build the Docker image, push it, and then remove it afterwards
-    build_image(client, build_path, image_name)
-    push_image(client, image_name)
-    remove_image(client, image_name)
+    # Build the Docker images, push them concurrently, and then remove them afterwards
+    built_images = []
+    try:
+        for build_path, image_name in images:
+            if not build_image(client, build_path, image_name):
+                sys.exit(1)
+            built_images.append(image_name)
+        if not push_images(client, built_images):
+            sys.exit(1)
+    finally:
+        # Remove the images even if a build or push failed, to keep the runner's image store small
+        for image_name in built_images:
+            remove_image(client, image_name)
 
 
 if __name__ == "__main__":
     main()
-
@@ -10,7 +10,11 @@ pkgs.mkShell {
   shellHook = ''
     poetry env use 3.12
     poetry install --no-root
-    poetry run python build.py -e $DEPLOYMENT_ENV -v $VERSION
+    if [ "$DEPLOYMENT_ENV" = "production" ]; then
+      poetry run python build.py --production
+    else
+      poetry run python build.py --no-production -v $VERSION
+    fi
     exit
   '';
 }